@@ -1,18 +1,15 @@
 """
 Denoise sensor
 """
-import datetime
 import logging
 import math
-import numbers
-from typing import Union, Optional, Dict, Any
-from collections import deque
+import time
+from typing import Union, Optional
+from array import array
+from operator import itemgetter
 
-import homeassistant.util.dt as dt_util
 import voluptuous as vol
-from homeassistant.components import history
 from homeassistant.components.climate import DOMAIN as CLIMATE_DOMAIN
-from homeassistant.components.group import expand_entity_ids
 from homeassistant.components.recorder.models import LazyState
 from homeassistant.components.sensor import (
     SensorEntity,
@@ -42,7 +39,7 @@ from homeassistant.core import (
 
 from homeassistant.helpers import config_validation as cv
 from homeassistant.helpers.config_validation import PLATFORM_SCHEMA
-from homeassistant.helpers.entity import Entity
+from homeassistant.helpers.debounce import Debouncer
 from homeassistant.helpers.event import async_track_state_change_event
 from homeassistant.util.unit_conversion import TemperatureConverter
 from homeassistant.util.unit_system import TEMPERATURE_UNITS
@@ -53,14 +50,36 @@ CONF_AVERAGE_INTERVAL = "average_interval"
 CONF_VALUE_DELTA = "value_delta"
 CONF_PRECISION = "precision"
 CONF_UPDATE_INTERVAL = "update_interval"
+CONF_FILTER = "filter"
+CONF_PROCESS_NOISE = "process_noise"
+CONF_MEASUREMENT_NOISE = "measurement_noise"
+
+FILTER_SMA = "sma"
+FILTER_EMA = "ema"
+FILTER_KALMAN = "kalman"
+FILTERS = [FILTER_SMA, FILTER_EMA, FILTER_KALMAN]
+
+DEFAULT_PROCESS_NOISE = 0.01
+DEFAULT_MEASUREMENT_NOISE = 1.0
+
+# coalesce state writes caused by bursts of source changes within this many seconds
+STATE_WRITE_COOLDOWN = 0.1
 
 class DOMAIN_TYPE:
     WEATHER = 1
     CLIMATE = 2
     OTHER = 3
 
+_DOMAIN_MAP = {
+    WEATHER_DOMAIN: DOMAIN_TYPE.WEATHER,
+    CLIMATE_DOMAIN: DOMAIN_TYPE.CLIMATE,
+    WATER_HEATER_DOMAIN: DOMAIN_TYPE.CLIMATE,
+}
+
 _LOGGER = logging.getLogger(__name__)
 
+_BAD_STATES = frozenset((STATE_UNKNOWN, STATE_UNAVAILABLE, "None"))
+
 PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
     {
         vol.Required(CONF_ENTITY_ID): cv.entity_id,
@@ -70,9 +89,94 @@ PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
         vol.Optional(CONF_VALUE_DELTA, default=0): vol.Any(int, float),
         vol.Optional(CONF_UPDATE_INTERVAL): cv.time_period,
         vol.Optional(CONF_PRECISION, default=1): int,
+        vol.Optional(CONF_FILTER, default=FILTER_SMA): vol.In(FILTERS),
+        vol.Optional(CONF_PROCESS_NOISE, default=DEFAULT_PROCESS_NOISE): vol.All(vol.Coerce(float), vol.Range(min=0)),
+        vol.Optional(CONF_MEASUREMENT_NOISE, default=DEFAULT_MEASUREMENT_NOISE): vol.All(vol.Coerce(float), vol.Range(min=0, min_included=False)),
     }
 )
 
+def _ema_step(x, z, dt, tau):
+    """Return the exponential moving average x updated with sample z taken dt after the previous one.
+
+    z must be finite, a nan/inf sample would stick in the average for good.
+    """
+    if dt <= 0:
+        return x
+    alpha = dt / (tau + dt)
+    return x + alpha * (z - x)
+
+def _kalman_step(x, p, z, q, r):
+    """Return the estimate x and its variance p updated with measurement z.
+
+    z must be finite, a nan/inf measurement would stick in the estimate for good.
+    """
+    p += q
+    gain = p / (p + r)
+    return x + gain * (z - x), p * (1 - gain)
+
+class _SampleWindow:
+    """Ring buffer of (timestamp, value) samples with a running sum of the values.
+
+    Samples are packed into int64/float64 arrays (8 bytes each) instead of
+    Python objects, the capacity doubles when the buffer is full.
+    """
+
+    __slots__ = ("_ts", "_vals", "_head", "_len", "sum")
+
+    def __init__(self, capacity=64):
+        self._ts = array("q", bytes(8 * capacity))
+        self._vals = array("d", bytes(8 * capacity))
+        self._head = 0
+        self._len = 0
+        self.sum = 0.0
+
+    def __len__(self):
+        return self._len
+
+    def expire(self, cutoff_ns):
+        """Remove the samples older than cutoff_ns."""
+        ts, vals = self._ts, self._vals
+        cap = len(ts)
+        head, size, total = self._head, self._len, self.sum
+        while size and ts[head] < cutoff_ns:
+            total -= vals[head]
+            head += 1
+            if head == cap:
+                head = 0
+            size -= 1
+        # reset the running sum when the window empties so float error does not accumulate
+        if not size:
+            head, total = 0, 0.0
+        self._head, self._len, self.sum = head, size, total
+
+    def append(self, ts_ns, value):
+        """Add a sample to the end of the window."""
+        cap = len(self._ts)
+        if self._len == cap:
+            self._grow()
+            cap = len(self._ts)
+        tail = self._head + self._len
+        if tail >= cap:
+            tail -= cap
+        self._ts[tail] = ts_ns
+        self._vals[tail] = value
+        self._len += 1
+        self.sum += value
+
+    def values(self):
+        """Return the values in the window, oldest first."""
+        end = self._head + self._len
+        vals = self._vals[self._head:end]
+        if end > len(self._vals):
+            vals += self._vals[:end - len(self._vals)]
+        return vals.tolist()
+
+    def _grow(self):
+        head, cap = self._head, len(self._ts)
+        self._ts = self._ts[head:] + self._ts[:head] + array("q", bytes(8 * cap))
+        self._vals = self._vals[head:] + self._vals[:head] + array("d", bytes(8 * cap))
+        self._head = 0
+
 # pylint: disable=unused-argument
 async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
     """Set up platform."""
@@ -83,18 +187,63 @@ async def async_setup_platform(hass, config, async_add_entities, discovery_info=
     update_interval = config.get(CONF_UPDATE_INTERVAL)
     entity_id = config.get(CONF_ENTITY_ID)
     precision = config.get(CONF_PRECISION)
+    filter_type = config.get(CONF_FILTER)
+    process_noise = config.get(CONF_PROCESS_NOISE)
+    measurement_noise = config.get(CONF_MEASUREMENT_NOISE)
 
-    _LOGGER.info("Setup [%s] unique_id[%s] entity_id[%s] val_delta[%s] prec[%s] average_interval[%s] update_interval[%s]",
-        name, unique_id, value_delta, precision, average_interval, update_interval)
+    _LOGGER.info("Setup [%s] unique_id[%s] entity_id[%s] val_delta[%s] prec[%s] average_interval[%s] update_interval[%s] "
+        "filter[%s] process_noise[%s] measurement_noise[%s]",
+        name, unique_id, entity_id, value_delta, precision, average_interval, update_interval,
+        filter_type, process_noise, measurement_noise)
 
     async_add_entities(
-        [DenoiseSensor(hass, name, unique_id, entity_id, value_delta, precision, average_interval, update_interval)]
+        [DenoiseSensor(hass, name, unique_id, entity_id, value_delta, precision, average_interval, update_interval,
+            filter_type, process_noise, measurement_noise)]
     )
 
 # pylint: disable=r0902
 class DenoiseSensor(SensorEntity):
     """Implementation of the Denoise sensor."""
 
+    __slots__ = (
+        "_hass",
+        "_name",
+        "_unique_id",
+        "_src_entity_id",
+        "_precision",
+        "_value_delta",
+        "_average_interval",
+        "_update_interval",
+        "_average_interval_ns",
+        "_update_interval_ns",
+        "_filter_type",
+        "_state",
+        "_unit_of_measurement",
+        "_device_class",
+        "_icon",
+        "_temperature_mode",
+        "_last_value",
+        "_last_update",
+        "_updated",
+        "_avg_window",
+        "_ema_value",
+        "_ema_ts",
+        "_kx",
+        "_kP",
+        "_Q",
+        "_R",
+        "_filter_value",
+        "_time_based_filter",
+        "_needs_clock",
+        "_src_uom",
+        "_src_domain",
+        "_src_domain_type",
+        "_temp_convert",
+        "_extract",
+        "_debouncer",
+        "_write_pending",
+    )
+
     # pylint: disable=r0913
     def __init__(
         self,
@@ -106,6 +255,9 @@ class DenoiseSensor(SensorEntity):
         precision,
         average_interval,
         update_interval,
+        filter_type=FILTER_SMA,
+        process_noise=DEFAULT_PROCESS_NOISE,
+        measurement_noise=DEFAULT_MEASUREMENT_NOISE,
     ):
         """Initialize the sensor."""
         self._hass = hass
@@ -116,15 +268,36 @@ class DenoiseSensor(SensorEntity):
         self._value_delta = value_delta
         self._average_interval = average_interval
         self._update_interval = update_interval
+        self._average_interval_ns = None if average_interval is None else int(average_interval.total_seconds() * 1e9)
+        self._update_interval_ns = None if update_interval is None else int(update_interval.total_seconds() * 1e9)
+        self._filter_type = filter_type
         self._state = None
         self._unit_of_measurement = None
         self._device_class = None
         self._icon = None
         self._temperature_mode = None
+        self._src_uom = None
+        self._src_domain = None
+        self._src_domain_type = None
         self._last_value = None
         self._last_update = None
         self._updated = False
-        self._avg_deque = None if average_interval is None else deque(())
+        use_sma = average_interval is not None and filter_type == FILTER_SMA
+        self._avg_window = _SampleWindow() if use_sma else None
+        self._ema_value = None
+        self._ema_ts = None
+        self._kx = None
+        self._kP = 1.0
+        self._Q = process_noise
+        self._R = measurement_noise
+        self._filter_value = self._select_filter()
+        self._time_based_filter = self._filter_value in (self._get_avg_value, self._get_ema_value)
+        # the time is only needed for the update interval and the time based filters
+        self._needs_clock = update_interval is not None or self._time_based_filter
+        self._temp_convert = float
+        self._extract = None
+        self._debouncer = None
+        self._write_pending = False
 
     @property
     def force_update(self) -> bool:
@@ -132,7 +305,7 @@ class DenoiseSensor(SensorEntity):
         If True, a state change will be triggered anytime the state property is
         updated, not just when the value changes.
         """
-        return self._updated
+        return self._updated or self._write_pending
 
     @property
     def _has_update_interval(self) -> bool:
@@ -186,41 +359,61 @@ class DenoiseSensor(SensorEntity):
 
     async def async_added_to_hass(self) -> None:
         """Register callbacks."""
+        self._debouncer = Debouncer(
+            self._hass,
+            _LOGGER,
+            cooldown=STATE_WRITE_COOLDOWN,
+            immediate=True,
+            function=self._async_flush_state,
+        )
+
         # pylint: disable=unused-argument
         @callback
         def sensor_state_listener(event: Event[EventStateChangedData]):
             """Handle device state changes."""
-            self._update_state()
-            if self.force_update:
-                self.async_schedule_update_ha_state(False)
+            if event is None:
+                self._update_state()
+            else:
+                new_state = event.data["new_state"]
+                # the source entity was removed
+                if new_state is None:
+                    return
+                self._update_state(state=new_state)
+            if self._updated:
+                self._write_pending = True
+                self._debouncer.async_schedule_call()
 
         # pylint: disable=unused-argument
         @callback
         def sensor_startup(event):
             """Track changes and initial update"""
-            async_track_state_change_event(
-                self._hass,
-                [self._src_entity_id],
-                sensor_state_listener,
+            self.async_on_remove(
+                async_track_state_change_event(
+                    self._hass,
+                    [self._src_entity_id],
+                    sensor_state_listener,
+                )
             )
             sensor_state_listener(None)
 
         self._hass.bus.async_listen_once(EVENT_HOMEASSISTANT_START, sensor_startup)
 
-    def update(self):
+    async def async_will_remove_from_hass(self) -> None:
+        """Cancel any pending state write and ignore later ones."""
+        if self._debouncer is not None:
+            self._debouncer.async_shutdown()
+
+    @callback
+    def _async_flush_state(self) -> None:
+        """Write the pending sensor state."""
+        self.async_write_ha_state()
+        self._write_pending = False
+
+    async def async_update(self) -> None:
         """Update the sensor state if it needed."""
         if self._has_update_interval:
             self._update_state(time_trigger=True)
 
-    @staticmethod
-    def _has_state(state) -> bool:
-        """Return True if state has any value."""
-        return state is not None and state not in [
-            STATE_UNKNOWN,
-            STATE_UNAVAILABLE,
-            "None",
-        ]
-
     def _init_entity(self, state: LazyState):
         """Init entity attributes"""
         # Assume a temperature entity
@@ -231,103 +424,158 @@ class DenoiseSensor(SensorEntity):
         self._src_uom = self._unit_of_measurement
         self._src_domain = split_entity_id(state.entity_id)[0]
 
-        if self._src_domain == WEATHER_DOMAIN:
-            self._src_domain_type = DOMAIN_TYPE.WEATHER
-        elif self._src_domain in (CLIMATE_DOMAIN, WATER_HEATER_DOMAIN):
-            self._src_domain_type = DOMAIN_TYPE.CLIMATE
-        else:
-            self._src_domain_type = DOMAIN_TYPE.OTHER
-            self._src_uom = state.attributes.get(ATTR_UNIT_OF_MEASUREMENT)
+        self._src_domain_type = _DOMAIN_MAP.get(self._src_domain, DOMAIN_TYPE.OTHER)
+
+        if self._src_domain_type == DOMAIN_TYPE.OTHER:
+            attributes = state.attributes
+            self._src_uom = attributes.get(ATTR_UNIT_OF_MEASUREMENT)
             self._temperature_mode = self._src_uom in TEMPERATURE_UNITS
             if not self._temperature_mode:
                 self._unit_of_measurement = self._src_uom
-                self._device_class = state.attributes.get(ATTR_DEVICE_CLASS)
-                self._icon = state.attributes.get(ATTR_ICON)
-
-    def _get_temperature(self, state: LazyState) -> Optional[float]:
-        """Get temperature value from entity."""
-        if self._src_domain_type == DOMAIN_TYPE.WEATHER:
-            temperature = state.attributes.get("temperature")
-        elif self._src_domain_type == DOMAIN_TYPE.CLIMATE:
-            temperature = state.attributes.get("current_temperature")
-        else:
-            temperature = state.state
+                self._device_class = attributes.get(ATTR_DEVICE_CLASS)
+                self._icon = attributes.get(ATTR_ICON)
 
-        if not self._has_state(temperature):
-            return None
-
-        temperature = TemperatureConverter.convert(float(temperature), self._src_uom, self._unit_of_measurement)
-        return temperature
-
-    def _get_state_value(self, state: LazyState) -> Optional[float]:
-        """Return value of given entity state."""
-        if self._temperature_mode:
-            return self._get_temperature(state)
-
-        state = state.state
-        if not self._has_state(state):
-            return None
-
-        try:
-            state = float(state)
-        except ValueError:
-            _LOGGER.error('Could not convert value "%s" to float', state)
+        # temperature units convert linearly, resolve the conversion once instead of per sample
+        if self._src_uom == self._unit_of_measurement:
+            self._temp_convert = float
+        else:
+            offset = TemperatureConverter.convert(0.0, self._src_uom, self._unit_of_measurement)
+            scale = TemperatureConverter.convert(1.0, self._src_uom, self._unit_of_measurement) - offset
+            self._temp_convert = lambda value, scale=scale, offset=offset: scale * float(value) + offset
+
+        self._extract = self._make_extractor()
+
+    def _make_extractor(self):
+        """Return a function that reads the value of a state of the source entity."""
+        convert = self._temp_convert if self._temperature_mode else float
+
+        if self._src_domain_type == DOMAIN_TYPE.OTHER:
+            def extract(state: LazyState) -> Optional[float]:
+                value = state.state
+                if value is None or value in _BAD_STATES:
+                    return None
+                try:
+                    value = convert(value)
+                except ValueError:
+                    _LOGGER.error('Could not convert value "%s" to float', value)
+                    return None
+                # nan/inf would poison the running sum and the filter state
+                return value if math.isfinite(value) else None
+            return extract
+
+        get_value = itemgetter("temperature" if self._src_domain_type == DOMAIN_TYPE.WEATHER else "current_temperature")
+
+        # the attributes are only read for weather and climate sources, the other sources only need state.state
+        def extract_attribute(state: LazyState) -> Optional[float]:
+            try:
+                value = get_value(state.attributes)
+            except KeyError:
+                return None
+            try:
+                # the membership test raises TypeError for unhashable attribute values
+                if value is None or value in _BAD_STATES:
+                    return None
+                value = convert(value)
+            except (TypeError, ValueError):
+                _LOGGER.error('Could not convert value "%s" to float', value)
+                return None
+            return value if math.isfinite(value) else None
+        return extract_attribute
+
+    def _select_filter(self):
+        """Return the filter function for the configured filter, None if the source value is used as is."""
+        if self._filter_type == FILTER_KALMAN:
+            return self._get_kalman_value
+        if self._average_interval is None:
             return None
+        if self._filter_type == FILTER_EMA:
+            return self._get_ema_value
+        return self._get_avg_value
 
-        return state
-
-    def _get_avg_value(self, now_ts, new_value):
+    def _get_avg_value(self, now_ns, new_value):
         # remove any old values from the left
-        while self._avg_deque and now_ts - self._avg_deque[0][0] > self._average_interval:
-            self._avg_deque.popleft()
+        window = self._avg_window
+        window.expire(now_ns - self._average_interval_ns)
         # insert new value to the right
-        self._avg_deque.append((now_ts, new_value))
-        avg_val = sum(v[1] for v in self._avg_deque) / len(self._avg_deque)
+        window.append(now_ns, new_value)
+        avg_val = window.sum / len(window)
         if _LOGGER.isEnabledFor(logging.DEBUG):
-            _LOGGER.debug("[%s] avg_val [%s] %s", self._name, avg_val, [v[1] for v in self._avg_deque])
+            _LOGGER.debug("[%s] avg_val [%s] %s", self._name, avg_val, window.values())
         return avg_val
 
-    def _update_state(self, time_trigger=False):  # pylint: disable=r0914,r0912,r0915
-        """Update the sensor state."""
+    def _get_ema_value(self, now_ns, new_value):
+        # average_interval is the time constant, weight the new sample by the time since the previous one
+        if self._ema_value is None:
+            self._ema_value = new_value
+        else:
+            self._ema_value = _ema_step(self._ema_value, new_value, now_ns - self._ema_ts, self._average_interval_ns)
+        self._ema_ts = now_ns
+        if _LOGGER.isEnabledFor(logging.DEBUG):
+            _LOGGER.debug("[%s] ema_val [%s]", self._name, self._ema_value)
+        return self._ema_value
+
+    # pylint: disable=unused-argument
+    def _get_kalman_value(self, now_ns, new_value):
+        # scalar Kalman filter with a constant state model, the first sample initialises the estimate
+        if self._kx is None:
+            self._kx = new_value
+        else:
+            self._kx, self._kP = _kalman_step(self._kx, self._kP, new_value, self._Q, self._R)
+        if _LOGGER.isEnabledFor(logging.DEBUG):
+            _LOGGER.debug("[%s] kalman_val [%s] P[%s]", self._name, self._kx, self._kP)
+        return self._kx
+
+    def _update_state(self, time_trigger=False, state: Optional[LazyState] = None):  # pylint: disable=r0914,r0912,r0915
+        """Update the sensor state, from the given source state or the current one if not given."""
 
         self._updated = False
-        now_ts = dt_util.utcnow()
+        now_ns = time.monotonic_ns() if self._needs_clock else 0
 
-        update_time = (self._has_update_interval and (self._last_update is None or
-            now_ts - self._last_update >= self._update_interval))
+        update_time = (self._update_interval_ns is not None and (self._last_update is None or
+            now_ns - self._last_update >= self._update_interval_ns))
 
-        if time_trigger and (not update_time and self._average_interval is None):
-            return
+        if time_trigger and not self._time_based_filter:
+            if not update_time:
+                return
+            # the Kalman filter only takes measurements from source changes, republish the last state as is
+            if self._filter_value is not None:
+                self._last_update = now_ns
+                self._updated = True
+                return
 
-        state = self._hass.states.get(self._src_entity_id)  # type: LazyState
         if state is None:
-            _LOGGER.error('Unable to find entity "%s"', self._src_entity_id)
-            return
+            state = self._hass.states.get(self._src_entity_id)  # type: LazyState
+            if state is None:
+                _LOGGER.error('Unable to find entity "%s"', self._src_entity_id)
+                return
 
         # if not initialised
         if self._temperature_mode is None:
             self._init_entity(state)
 
         # Get current state
-        new_value = self._get_state_value(state)
+        new_value = self._extract(state)
 
-        if isinstance(new_value, numbers.Number):
-            _LOGGER.debug("[%s] new_value [%s]", self._name, new_value)
+        if new_value is not None:
+            if _LOGGER.isEnabledFor(logging.DEBUG):
+                _LOGGER.debug("[%s] new_value [%s]", self._name, new_value)
 
-            if self._average_interval is not None:
-                new_value = self._get_avg_value(now_ts, new_value)
+            if self._filter_value is not None:
+                new_value = self._filter_value(now_ns, new_value)
 
             update_value = self._last_value is None or abs(new_value - self._last_value) >= self._value_delta
-            new_state = round(new_value, self._precision)
-            state_changed = new_state != self._state
-
-            if update_time or (update_value and state_changed):
-                if _LOGGER.isEnabledFor(logging.DEBUG):
-                    _LOGGER.debug("Update [%s] time_trig[%d] upd_time[%d] upt_val[%d] val[%s->%s] st[%s->%s]",
-                        self._name, time_trigger, update_time, update_value, self._last_value, new_value, self._state, new_state)
-                self._state = new_state
-                self._last_update = now_ts
-                self._updated = True
+
+            # only round when the state can be published, a forced update does not need the comparison
+            if update_time or update_value:
+                new_state = round(new_value, self._precision)
+                if update_time or new_state != self._state:
+                    if _LOGGER.isEnabledFor(logging.DEBUG):
+                        _LOGGER.debug("Update [%s] time_trig[%d] upd_time[%d] upt_val[%d] val[%s->%s] st[%s->%s]",
+                            self._name, time_trigger, update_time, update_value, self._last_value, new_value,
+                            self._state, new_state)
+                    self._state = new_state
+                    self._last_update = now_ns
+                    self._updated = True
 
             if update_value:
                 self._last_value = new_value
@@ -335,5 +583,5 @@ class DenoiseSensor(SensorEntity):
         else:
             self._last_value = None
             self._state = None
-            self._last_update = now_ts
+            self._last_update = now_ns
             self._updated = True